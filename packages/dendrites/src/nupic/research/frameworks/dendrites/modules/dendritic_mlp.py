@@ -21,17 +21,37 @@
 
 from collections.abc import Iterable
 
-import numpy as np
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 from nupic.research.frameworks.dendrites.modules.dendritic_layers import (
     AbsoluteMaxGatingDendriticLayer,
+    DendriticLayerBase,
     OneSegmentDendriticLayer,
 )
 from nupic.torch.modules import KWinners, SparseWeights, rezero_weights
 
 
+class _KWinnersInference(nn.Module):
+    """
+    Inference-only k-winners without boosting: keeps the `k` largest activations of
+    each sample, along with any ties, and zeros the rest. This matches `KWinners` in
+    eval mode when `boost_strength` is 0.
+    """
+
+    def __init__(self, k):
+        super().__init__()
+        self.k = k
+
+    def extra_repr(self):
+        return f"k={self.k}"
+
+    def forward(self, x):
+        threshold = x.topk(self.k, dim=-1).values[..., -1:]
+        return x.masked_fill(x < threshold, 0)
+
+
 class DendriticMLP(nn.Module):
     """
     A simple but restricted MLP with two hidden layers of the same size. Each hidden
@@ -61,6 +81,17 @@ class DendriticMLP(nn.Module):
     :param dendritic_layer_class: dendritic layer class to use for each hidden layer
     :param output_nonlinearity: nonlinearity to apply to final output layer.
                                 'None' of no nonlinearity.
+    :param sparsity_pattern: structured sparsity pattern additionally enforced on the
+                             feed-forward weights of each hidden layer. Either None
+                             (unstructured only) or "2:4", in which case at most 2 of
+                             every 4 consecutive weights in a row are non-zero, as
+                             required by Sparse Tensor Cores (see
+                             `optimize_for_inference`)
+    :param use_compile: whether to compile the hidden layers with `torch.compile`
+                        (pytorch>=2.0), so that their small memory-bound ops are
+                        fused into fewer kernels. Compilation happens on the first
+                        forward pass; copied and unpickled models compile their own
+                        hidden layers again
                     _____
                    |_____|    # classifier layer, no dendrite input
                       ^
@@ -93,6 +124,8 @@ class DendriticMLP(nn.Module):
         freeze_dendrites=False,
         output_nonlinearity=None,
         dendritic_layer_class=AbsoluteMaxGatingDendriticLayer,
+        sparsity_pattern=None,
+        use_compile=False,
     ):
 
         # Forward & dendritic weight initialization must be either "kaiming" or
@@ -101,6 +134,9 @@ class DendriticMLP(nn.Module):
         assert dendrite_init in ("kaiming", "modified")
         assert kw_percent_on is None or (kw_percent_on >= 0.0 and kw_percent_on < 1.0)
         assert context_percent_on >= 0.0
+        assert sparsity_pattern in (None, "2:4")
+        assert not use_compile or hasattr(torch, "compile"), \
+            "use_compile requires pytorch>=2.0"
 
         if kw_percent_on == 0.0:
             kw = False
@@ -122,6 +158,10 @@ class DendriticMLP(nn.Module):
         self.dendrite_weight_sparsity = dendrite_weight_sparsity
         self.output_nonlinearity = output_nonlinearity
         self.hardcode_dendrites = (dendrite_init == "hardcoded")
+        self.sparsity_pattern = sparsity_pattern
+        self.use_compile = use_compile
+        self._inference_dtype = None
+        self.register_buffer("_fused_segment_weights", None, persistent=False)
 
         self._layers = nn.ModuleList()
         self._activations = nn.ModuleList()
@@ -161,14 +201,16 @@ class DendriticMLP(nn.Module):
                         1 - kw_percent_on if kw else 0.0
                     )
 
+            if self.sparsity_pattern == "2:4":
+                self._project_2_4_sparsity(curr_dend)
+
             if dendrite_init == "modified":
                 self._init_sparse_dendrites(curr_dend, 1 - context_percent_on)
 
-            if freeze_dendrites:
+            segments = getattr(curr_dend, "segments", None)
+            if freeze_dendrites and segments is not None:
                 # Dendritic weights will not be updated during backward pass
-                for name, param in curr_dend.named_parameters():
-                    if "segments" in name:
-                        param.requires_grad = False
+                segments.requires_grad_(False)
 
             if self.kw:
                 curr_activation = KWinners(n=hidden_sizes[i],
@@ -184,6 +226,8 @@ class DendriticMLP(nn.Module):
 
             input_size = self.hidden_sizes[i]
 
+        self._build_hidden_blocks()
+
         self._single_output_head = not isinstance(output_size, Iterable)
         if self._single_output_head:
             output_size = (output_size,)
@@ -202,16 +246,148 @@ class DendriticMLP(nn.Module):
                 output_layer.add_module("non_linearity", output_nonlinearity)
             self._output_layers.append(output_layer)
 
+        # Output sizes used to split the result of the fused multi-head linear layer
+        self._output_head_sizes = list(output_size)
+        self._fused_output_cache = None
+
+        self._compile_hidden_layers()
+
+    def _compile_hidden_layers(self):
+        """
+        With `use_compile`, compile the hidden layers. The unbound method is compiled
+        and the model passed on each call, so the compiled function doesn't reference
+        the model: a deep copy runs its own hidden layers, and the model is freed
+        without a reference cycle.
+        """
+        self._compiled_forward_hidden = None
+        if self.use_compile:
+            # Let inductor fuse the feed-forward epilogue, dendritic gating and
+            # k-winners of each hidden layer
+            self._compiled_forward_hidden = torch.compile(
+                type(self)._forward_hidden_layers, dynamic=False
+            )
+
+    def __getstate__(self):
+        # The compiled function can't be pickled; it's compiled again on loading
+        state = self.__dict__.copy()
+        state["_compiled_forward_hidden"] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._compile_hidden_layers()
+
+    def _build_hidden_blocks(self):
+        """
+        Pair each hidden layer with its activation once, so `forward` iterates a plain
+        tuple instead of zipping two `ModuleList`s on every call, and collect the
+        dendrite segment weights used by `hardcode_dendritic_weights`. The modules
+        stay registered in `_layers` and `_activations`; call this again after
+        replacing any of them or their segment weights.
+        """
+        self._hidden_blocks = tuple(zip(self._layers, self._activations))
+        self._segment_weights = tuple(
+            layer.segment_weights for layer in self._layers
+            if layer.segment_weights is not None
+        )
+
     def forward(self, x, context=None):
+        if self._single_output_head:
+            return self._forward_single_head(x, context)
+        else:
+            return self._forward_output_heads(x, context)
+
+    def _forward_hidden(self, x, context):
+        if self._compiled_forward_hidden is not None:
+            return self._compiled_forward_hidden(self, x, context)
+        return self._forward_hidden_layers(x, context)
+
+    def _forward_hidden_layers(self, x, context):
         assert (context is not None) or (self.num_segments == 0)
-        for layer, activation in zip(self._layers, self._activations):
+        if self._inference_dtype is not None:
+            # All parameters were cast by `optimize_for_inference`, so only inputs
+            # need to be converted, once, rather than per op under autocast
+            x = x.to(self._inference_dtype)
+            if context is not None:
+                context = context.to(self._inference_dtype)
+
+        if context is not None:
+            # Every hidden layer projects the same context; make it contiguous once
+            # rather than letting each layer's einsum copy it
+            context = context.contiguous()
+
+        if self._fused_segment_weights is not None:
+            # Compute the dendritic activations of all hidden layers at once, as they
+            # all receive the same context. Flattening the units and segments turns
+            # the projection into a single matmul
+            num_units, num_segments, dim_context = self._fused_segment_weights.size()
+            dendrite_activations = F.linear(
+                context, self._fused_segment_weights.view(-1, dim_context)
+            ).view(-1, num_units, num_segments).split(self._fused_segment_sizes, dim=1)
+            for (layer, activation), dendrites in zip(self._hidden_blocks,
+                                                      dendrite_activations):
+                x = activation(layer.apply_dendrites(layer.module(x), dendrites))
+            return x
+
+        for layer, activation in self._hidden_blocks:
             x = activation(layer(x, context))
+        return x
 
-        if self._single_output_head:
-            return self._output_layers[0](x)
-        else:
+    def _forward_single_head(self, x, context=None):
+        # Call the output layer's modules directly rather than through its
+        # `nn.Sequential`, which is kept so state dict keys don't change
+        x = self._output_layers[0].output_linear(self._forward_hidden(x, context))
+        if self.output_nonlinearity is not None:
+            x = self.output_nonlinearity(x)
+        return x
+
+    def _forward_output_heads(self, x, context=None):
+        """
+        Compute all output heads. In eval mode this is a single linear layer whose
+        weights are the concatenation of the weights of each head, rather than one
+        small matmul per head. The weights of each head are already rezeroed, so no
+        masking is needed. In training mode each head is called separately, so forward
+        hooks on the output layers keep firing.
+        """
+        x = self._forward_hidden(x, context)
+        if self.training:
             return [out_layer(x) for out_layer in self._output_layers]
 
+        weight, bias = self._fused_output_weights()
+        outputs = torch.split(F.linear(x, weight, bias), self._output_head_sizes,
+                              dim=-1)
+        if self.output_nonlinearity is not None:
+            return [self.output_nonlinearity(out) for out in outputs]
+        return list(outputs)
+
+    def _fused_output_weights(self):
+        """
+        Return the concatenated weights and biases of all output heads. After
+        `optimize_for_inference`, which freezes the weights, they are concatenated
+        once and reused; otherwise they are concatenated on every call, so changes to
+        the weights of any head (e.g. `load_state_dict`) are always picked up.
+        """
+        if self._fused_output_cache is not None:
+            return self._fused_output_cache
+
+        linears = [out_layer.output_linear.module for out_layer in self._output_layers]
+        return (torch.cat([linear.weight for linear in linears], dim=0),
+                torch.cat([linear.bias for linear in linears], dim=0))
+
+    def _apply(self, fn, *args, **kwargs):
+        # Moving or casting the model (e.g. `to`, `cuda`, `half`) converts the fused
+        # segment weights and the per-layer segment weights separately, so fuse them
+        # again to keep the layers as views into a single tensor. The concatenated
+        # output weights are taken again from the converted weights
+        super()._apply(fn, *args, **kwargs)
+        if self._fused_segment_weights is not None:
+            self._fuse_dendrite_segments()
+        if self._fused_output_cache is not None:
+            with torch.no_grad():
+                self._fused_output_cache = None
+                self._fused_output_cache = self._fused_output_weights()
+        return self
+
     # ------ Weight initialization functions ------
     @staticmethod
     def _init_sparse_weights(m, input_sparsity):
@@ -222,9 +398,10 @@ class DendriticMLP(nn.Module):
         input_density = 1.0 - input_sparsity
         weight_density = 1.0 - m.sparsity
         _, fan_in = m.module.weight.size()
-        bound = 1.0 / np.sqrt(input_density * weight_density * fan_in)
-        nn.init.uniform_(m.module.weight, -bound, bound)
-        m.apply(rezero_weights)
+        bound = (input_density * weight_density * fan_in) ** -0.5
+        with torch.no_grad():
+            m.module.weight.uniform_(-bound, bound)
+            m.module.weight.masked_fill_(m.zero_mask.bool(), 0)
 
     @staticmethod
     def _init_sparse_dendrites(m, input_sparsity):
@@ -237,9 +414,150 @@ class DendriticMLP(nn.Module):
             input_density = 1.0 - input_sparsity
             weight_density = 1.0 - m.segments.sparsity
             fan_in = m.dim_context
-            bound = 1.0 / np.sqrt(input_density * weight_density * fan_in)
-            nn.init.uniform_(m.segment_weights, -bound, bound)
-            m.apply(rezero_weights)
+            bound = (input_density * weight_density * fan_in) ** -0.5
+            with torch.no_grad():
+                m.segment_weights.uniform_(-bound, bound)
+                m.segment_weights.masked_fill_(m.segments.zero_mask.bool(), 0)
+
+    @staticmethod
+    def _project_2_4_sparsity(m):
+        """
+        Restrict the feed-forward weights of `m` to the 2:4 semi-structured sparsity
+        pattern by zeroing the two smallest magnitudes in each group of 4 consecutive
+        weights of a row. The pruned weights are added to the zero mask so that the
+        pattern is kept by `rezero_weights` during training.
+        """
+        weight = m.module.weight
+        out_features, in_features = weight.size()
+        assert in_features % 4 == 0, "2:4 sparsity requires a multiple of 4 inputs"
+
+        groups = weight.detach().abs().view(out_features, in_features // 4, 4)
+        smallest = groups.topk(2, dim=-1, largest=False).indices
+        off_mask = torch.zeros_like(groups, dtype=torch.bool)
+        off_mask.scatter_(-1, smallest, True)
+
+        m.zero_mask.masked_fill_(off_mask.view_as(weight), 1)
+        m.rezero_weights()
+
+    # ------ Inference ------
+    def optimize_for_inference(self, dtype=torch.bfloat16):
+        """
+        Convert the model for inference only. Sparse weights are rezeroed once and
+        their zero masks are dropped, as they are only needed to keep weights sparse
+        during training. The model is then cast to `dtype` and inputs are cast
+        accordingly in `forward`. With a 2:4 `sparsity_pattern`, the feed-forward
+        weights of the hidden layers are also converted to semi-structured sparse
+        tensors so that their matmuls dispatch to Sparse Tensor Cores; this requires a
+        CUDA device and layer sizes supported by CUTLASS.
+
+        Call this once, e.g. after loading a checkpoint. The dense model should be
+        kept around for training, as this conversion can't be undone.
+
+        :param dtype: either `torch.bfloat16` or `torch.float16`. Halving the weight
+                      width halves the memory traffic of the mostly memory-bound
+                      hidden and output layers, and allows tensor core kernels to be
+                      used. BF16 keeps the FP32 exponent range and is preferred on
+                      hardware that supports it.
+        """
+        assert self._inference_dtype is None, "already optimized for inference"
+        assert not self.training
+        assert dtype in (torch.float16, torch.bfloat16)
+
+        # Check the 2:4 conversion can succeed before the model is modified
+        if self.sparsity_pattern == "2:4":
+            to_sparse_semi_structured = self._semi_structured_converter()
+
+        # `SparseWeights` and `DendriteSegments` don't mask their weights in
+        # `forward`; rezero once so the stored weights are exactly the masked ones
+        self.apply(rezero_weights)
+        for m in self.modules():
+            if hasattr(m, "zero_mask"):
+                del m.zero_mask
+
+        self.to(dtype)
+        self._inference_dtype = dtype
+
+        # Without boosting, k-winners at inference is a plain top-k; drop the boosting
+        # and duty cycle machinery
+        for i, activation in enumerate(self._activations):
+            if (isinstance(activation, KWinners) and activation.boost_strength == 0
+                    and activation.k_inference > 0):
+                self._activations[i] = _KWinnersInference(activation.k_inference)
+        self._build_hidden_blocks()
+        self._fuse_dendrite_segments()
+
+        # The output weights are frozen from here on; concatenate them once
+        if not self._single_output_head:
+            with torch.no_grad():
+                self._fused_output_cache = self._fused_output_weights()
+
+        if self.sparsity_pattern == "2:4":
+            for layer in self._layers:
+                weight = layer.module.weight.detach()
+                layer.module.weight = nn.Parameter(
+                    to_sparse_semi_structured(weight), requires_grad=False
+                )
+
+    def _semi_structured_converter(self):
+        """
+        Check that the feed-forward weights of the hidden layers can be converted to
+        semi-structured sparse tensors, and return the conversion function.
+        """
+        try:
+            from torch.sparse import (
+                SparseSemiStructuredTensor,
+                to_sparse_semi_structured,
+            )
+        except ImportError:
+            raise ImportError(
+                "2:4 semi-structured sparsity requires pytorch>=2.1"
+            )
+
+        for layer in self._layers:
+            weight = layer.module.weight
+            assert weight.is_cuda, "2:4 semi-structured sparsity requires a CUDA device"
+            assert torch.cuda.get_device_capability(weight.device) >= (8, 0), \
+                "2:4 semi-structured sparsity requires an Ampere or newer GPU"
+
+            # Minimum shapes of the CUTLASS kernels for 16-bit dtypes
+            rows, cols = weight.size()
+            assert rows % 32 == 0 and cols % 64 == 0, \
+                f"2:4 semi-structured sparsity requires layer output sizes that " \
+                f"are multiples of 32 and input sizes that are multiples of 64, " \
+                f"got {rows}x{cols}"
+
+        SparseSemiStructuredTensor._FORCE_CUTLASS = True
+        return to_sparse_semi_structured
+
+    def _fuse_dendrite_segments(self):
+        """
+        Concatenate the dendrite segment weights of all hidden layers along the unit
+        dimension, so that one einsum computes the dendritic activations of every
+        layer in `forward`. The segment weights of each layer are replaced by views
+        into the fused tensor, so no memory is duplicated. Moving or casting the
+        model afterwards fuses the converted segment weights again (see `_apply`).
+
+        This only applies when every hidden layer is a `DendriticLayerBase` with the
+        default forward pass and no dendrite biases.
+        """
+        fusable = len(self._layers) > 1 and all(
+            isinstance(layer, DendriticLayerBase)
+            and type(layer).forward is DendriticLayerBase.forward
+            and layer.segments.biases is None
+            for layer in self._layers
+        )
+        if not fusable:
+            return
+
+        self._fused_segment_weights = torch.cat(
+            [layer.segments.weights.detach() for layer in self._layers], dim=0
+        )
+        self._fused_segment_sizes = [layer.segments.num_units
+                                     for layer in self._layers]
+        fused_weights = self._fused_segment_weights.split(self._fused_segment_sizes)
+        for layer, weights in zip(self._layers, fused_weights):
+            layer.segments.weights = nn.Parameter(weights, requires_grad=False)
+        self._build_hidden_blocks()
 
     def hardcode_dendritic_weights(self, context_vectors, init):
         """
@@ -264,66 +582,75 @@ class DendriticMLP(nn.Module):
         :param init: a string "overlapping" or "non_overlapping"
         """
         if self.num_segments > 0:
-            for dendrite in self._layers:
-                self._hardcode_dendritic_weights(dendrite.weights, context_vectors,
-                                                 init)
+            for weights in self._segment_weights:
+                self._hardcode_dendritic_weights(weights, context_vectors, init)
 
     @staticmethod
     def _hardcode_dendritic_weights(dendrite_weights, context_vectors, init):
-        squeeze = False
-        if len(dendrite_weights.shape) == 2:
-            # 1 segment dendrite, so add in a segment dimension
-            squeeze = True
-            original_weights = dendrite_weights
-            dendrite_weights = dendrite_weights.unsqueeze(dim=1)
-
-        num_units, num_segments, dim_context = dendrite_weights.size()
+        # The new weights are built on the device of the dendrite weights and copied
+        # into them in place, which keeps their device and dtype
+        weights = dendrite_weights.data
+        if len(weights.shape) == 2:
+            # 1 segment dendrite, so add in a segment dimension; the view shares
+            # storage with the dendrite weights
+            weights = weights.unsqueeze(dim=1)
+
+        num_units, num_segments, dim_context = weights.size()
         num_contexts, _ = context_vectors.size()
+        context_vectors = context_vectors.to(weights)
 
         if init == "overlapping":
-            new_dendritic_weights = -0.95 * torch.ones((num_units, num_segments,
-                                                        dim_context))
+            new_dendritic_weights = torch.full((num_units, num_segments, dim_context),
+                                               -0.95, dtype=weights.dtype,
+                                               device=weights.device)
 
             # The number of units to allocate to each context (with replacement)
             k = int(0.05 * num_units)
 
-            # Keep track of the number of contexts for which each segment has already
-            # been chosen; this is to not overwrite a previously hardcoded segment
-            num_contexts_chosen = {i: 0 for i in range(num_units)}
-
-            for c in range(num_contexts):
-
-                # Pick k random units to be activated by the cth context
-                selected_units = torch.randperm(num_units)[:k]
-                for i in selected_units:
-                    i = i.item()
-
-                    # If num_segments other contexts have already selected unit i to
-                    # become active, skip
-                    segment_id = num_contexts_chosen[i]
-                    if segment_id == num_segments:
-                        continue
-
-                    new_dendritic_weights[i, segment_id, :] = context_vectors[c, :]
-                    num_contexts_chosen[i] += 1
+            # Pick k random units to be activated by each context, for all contexts at
+            # once: the k largest of num_units uniform samples form a random subset
+            selections = torch.rand(num_contexts, num_units).topk(k, dim=1).indices
+            unit_ids = selections.flatten()
+            context_ids = torch.arange(num_contexts).repeat_interleave(k)
+
+            # Group the (unit, context) pairs by unit; the stable sort keeps contexts
+            # in order so that earlier contexts claim a unit's segments first
+            unit_ids, order = torch.sort(unit_ids, stable=True)
+            context_ids = context_ids[order]
+
+            # The segment assigned to each pair is its rank among the pairs selecting
+            # the same unit
+            _, counts = torch.unique_consecutive(unit_ids, return_counts=True)
+            starts = torch.cumsum(counts, dim=0) - counts
+            segment_ids = (torch.arange(len(unit_ids))
+                           - starts.repeat_interleave(counts))
+
+            # If num_segments other contexts have already selected a unit to become
+            # active, skip
+            mask = segment_ids < num_segments
+            unit_ids = unit_ids[mask].to(weights.device)
+            segment_ids = segment_ids[mask].to(weights.device)
+            context_ids = context_ids[mask].to(weights.device)
+            new_dendritic_weights[unit_ids, segment_ids] = context_vectors[context_ids]
 
         elif init == "non_overlapping":
-            new_dendritic_weights = torch.zeros((num_units, num_segments, dim_context))
-
-            for i in range(num_units):
-                context_perm = context_vectors[torch.randperm(num_contexts), :]
-                new_dendritic_weights[i, :, :] = 1.0 * (context_perm[0, :] > 0)
-                new_dendritic_weights[i, 1:, :] = -1
-                new_dendritic_weights[i, 1:, :] += new_dendritic_weights[i, 0, :]
-                del context_perm
+            # Each unit recognizes a single random context; only the first element of
+            # a random permutation was ever used, so sample one index per unit
+            chosen_contexts = torch.randint(0, num_contexts, (num_units,))
+            chosen_contexts = chosen_contexts.to(weights.device)
+
+            # Threshold the (usually far fewer) context vectors before gathering one
+            # per unit, rather than gathering raw rows and thresholding each copy
+            first = (context_vectors > 0).to(weights)[chosen_contexts]
+
+            # The first segment matches the chosen context while the others contain
+            # negative weights for all other entries
+            new_dendritic_weights = first.unsqueeze(1).expand(
+                num_units, num_segments, dim_context
+            ).contiguous()
+            new_dendritic_weights[:, 1:, :] = first.unsqueeze(1) - 1.0
 
         else:
             raise Exception("Invalid dendritic weight hardcode choice")
 
-        dendrite_weights.data = new_dendritic_weights
-
-        if squeeze:
-            dendrite_weights = dendrite_weights.squeeze(dim=1)
-            # dendrite weights doesn't point to the dendrite weights tensor,
-            # so expicitly assign the new values
-            original_weights.data = dendrite_weights
+        weights.copy_(new_dendritic_weights)
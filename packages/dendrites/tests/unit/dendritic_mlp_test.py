@@ -0,0 +1,475 @@
+# ----------------------------------------------------------------------
+# Numenta Platform for Intelligent Computing (NuPIC)
+# Copyright (C) 2021, Numenta, Inc.  Unless you have an agreement
+# with Numenta, Inc., for a separate license for this software code, the
+# following terms and conditions apply:
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero Public License for more details.
+#
+# You should have received a copy of the GNU Affero Public License
+# along with this program.  If not, see http://www.gnu.org/licenses.
+#
+# http://numenta.org/licenses/
+# ----------------------------------------------------------------------
+
+import gc
+import pickle
+import unittest
+import weakref
+from copy import deepcopy
+
+import torch
+
+from nupic.research.frameworks.dendrites import DendriticMLP
+from nupic.research.frameworks.dendrites.modules.dendritic_mlp import (
+    _KWinnersInference,
+)
+from nupic.torch.modules import KWinners
+
+
+class HardcodeDendriticWeightsTest(unittest.TestCase):
+    """
+    Tests the hardcoded dendritic weight initializations of `DendriticMLP`
+    """
+
+    def setUp(self):
+        self.num_units = 100
+        self.num_segments = 5
+        self.dim_context = 20
+        self.num_contexts = 5
+        self.context_vectors = (torch.rand(self.num_contexts, self.dim_context)
+                                > 0.5).float()
+
+    def test_overlapping(self):
+        """
+        Each segment should either be left at -0.95 or hold one of the context
+        vectors, and every context should select k units.
+        """
+        weights = torch.nn.Parameter(
+            torch.empty(self.num_units, self.num_segments, self.dim_context)
+        )
+        DendriticMLP._hardcode_dendritic_weights(weights, self.context_vectors,
+                                                 "overlapping")
+
+        self.assertEqual(weights.shape, (self.num_units, self.num_segments,
+                                         self.dim_context))
+        segments = weights.data.view(-1, self.dim_context)
+        unused = (segments == -0.95).all(dim=1)
+        matches = (segments.unsqueeze(1) == self.context_vectors.unsqueeze(0)).all(
+            dim=2
+        )
+        self.assertTrue((unused | matches.any(dim=1)).all())
+
+        # Segments are filled in order, so an unused segment is never followed by a
+        # hardcoded one
+        unused = unused.view(self.num_units, self.num_segments)
+        self.assertTrue((unused[:, :-1] <= unused[:, 1:]).all())
+
+        # With as many segments as contexts, no selection is dropped
+        k = int(0.05 * self.num_units)
+        self.assertEqual((~unused).sum().item(), self.num_contexts * k)
+
+    def test_non_overlapping(self):
+        """
+        Each unit's first segment should match a single context vector and its other
+        segments should be negative everywhere else.
+        """
+        weights = torch.nn.Parameter(
+            torch.empty(self.num_units, self.num_segments, self.dim_context)
+        )
+        DendriticMLP._hardcode_dendritic_weights(weights, self.context_vectors,
+                                                 "non_overlapping")
+
+        self.assertEqual(weights.shape, (self.num_units, self.num_segments,
+                                         self.dim_context))
+        first = weights.data[:, 0, :]
+        matches = (first.unsqueeze(1) == self.context_vectors.unsqueeze(0)).all(dim=2)
+        self.assertTrue(matches.any(dim=1).all())
+        for s in range(1, self.num_segments):
+            self.assertTrue((weights.data[:, s, :] == first - 1.0).all())
+
+    def test_non_overlapping_one_segment(self):
+        """A 1-segment dendrite keeps its 2d shape."""
+        weights = torch.nn.Parameter(torch.empty(self.num_units, self.dim_context))
+        DendriticMLP._hardcode_dendritic_weights(weights, self.context_vectors,
+                                                 "non_overlapping")
+
+        self.assertEqual(weights.shape, (self.num_units, self.dim_context))
+        matches = (weights.data.unsqueeze(1)
+                   == self.context_vectors.unsqueeze(0)).all(dim=2)
+        self.assertTrue(matches.any(dim=1).all())
+
+    def test_hardcode_model(self):
+        """Every hidden layer of a `DendriticMLP` should be hardcoded."""
+        model = DendriticMLP(input_size=10, output_size=2, hidden_sizes=[20, 20],
+                             num_segments=self.num_segments,
+                             dim_context=self.dim_context, kw=False)
+        model.hardcode_dendritic_weights(self.context_vectors, "non_overlapping")
+
+        for layer in model._layers:
+            first = layer.segment_weights[:, 0, :]
+            matches = (first.unsqueeze(1)
+                       == self.context_vectors.unsqueeze(0)).all(dim=2)
+            self.assertTrue(matches.any(dim=1).all())
+
+
+class DendriticMLPForwardTest(unittest.TestCase):
+    """
+    Tests the forward pass of `DendriticMLP`
+    """
+
+    def setUp(self):
+        self.batch_size = 8
+        self.input_size = 12
+        self.dim_context = 15
+        self.model_args = dict(
+            input_size=self.input_size,
+            hidden_sizes=[16, 16],
+            num_segments=3,
+            dim_context=self.dim_context,
+            kw=True,
+            kw_percent_on=0.25,
+            weight_sparsity=0.5,
+            dendrite_weight_sparsity=0.5,
+        )
+        self.x = torch.rand(self.batch_size, self.input_size)
+        self.context = torch.rand(self.batch_size, self.dim_context)
+
+    def _hidden_forward(self, model):
+        x = self.x
+        for layer, activation in zip(model._layers, model._activations):
+            x = activation(layer(x, self.context))
+        return x
+
+    def test_single_output_head(self):
+        model = DendriticMLP(output_size=4, **self.model_args)
+        model.eval()
+
+        out = model(self.x, self.context)
+        self.assertEqual(out.shape, (self.batch_size, 4))
+
+    def test_multiple_output_heads(self):
+        """The fused output heads should match applying each head separately."""
+        output_size = (3, 4, 5)
+        model = DendriticMLP(output_size=output_size,
+                             output_nonlinearity=torch.nn.Tanh(),
+                             **self.model_args)
+        model.eval()
+
+        outputs = model(self.x, self.context)
+        hidden = self._hidden_forward(model)
+        self.assertEqual(len(outputs), len(output_size))
+        for out_size, out, out_layer in zip(output_size, outputs,
+                                            model._output_layers):
+            self.assertEqual(out.shape, (self.batch_size, out_size))
+            self.assertTrue(torch.allclose(out, out_layer(hidden), atol=1e-6))
+
+    def test_output_head_hooks_in_training(self):
+        """In training mode, forward hooks on each output head should fire."""
+        model = DendriticMLP(output_size=(3, 4), **self.model_args)
+        model.train()
+
+        called = []
+        for out_layer in model._output_layers:
+            out_layer.output_linear.module.register_forward_hook(
+                lambda module, inputs, output: called.append(module)
+            )
+
+        outputs = model(self.x, self.context)
+        self.assertEqual(len(called), 2)
+        self.assertEqual([out.shape[-1] for out in outputs], [3, 4])
+
+    def test_freed_without_gc(self):
+        """
+        A model shouldn't hold a reference to itself, so it's freed as soon as it's
+        deleted, without waiting for the cyclic garbage collector.
+        """
+        gc.disable()
+        try:
+            for output_size in (4, (3, 4)):
+                model = DendriticMLP(output_size=output_size, **self.model_args)
+                model(self.x, self.context)
+                model_ref = weakref.ref(model)
+                del model
+                self.assertIsNone(model_ref())
+        finally:
+            gc.enable()
+
+    def test_output_heads_follow_weight_changes(self):
+        """
+        In eval mode, the fused output heads should pick up weights loaded from a
+        checkpoint or written through `.data` and `rezero_weights`.
+        """
+        model = DendriticMLP(output_size=(3, 4), **self.model_args)
+        other_model = DendriticMLP(output_size=(3, 4), **self.model_args)
+        model.eval()
+        other_model.eval()
+
+        with torch.no_grad():
+            model(self.x, self.context)
+            model.load_state_dict(other_model.state_dict())
+            outputs = model(self.x, self.context)
+            expected = other_model(self.x, self.context)
+            for out, expected_out in zip(outputs, expected):
+                self.assertTrue(torch.allclose(out, expected_out))
+
+            output_linear = model._output_layers[0].output_linear
+            output_linear.module.weight.data.fill_(1.0)
+            output_linear.rezero_weights()
+            outputs = model(self.x, self.context)
+            hidden = self._hidden_forward(model)
+            expected = model._output_layers[0](hidden)
+            self.assertTrue(torch.allclose(outputs[0], expected, atol=1e-6))
+
+    def test_cached_output_heads(self):
+        """
+        After `optimize_for_inference`, the fused output weights should be
+        concatenated once and reused across forward passes, and converted with the
+        model.
+        """
+        model = DendriticMLP(output_size=(3, 4), **self.model_args)
+        model.eval()
+        self.assertIsNone(model._fused_output_cache)
+        model.optimize_for_inference()
+
+        with torch.no_grad():
+            weight, _ = model._fused_output_cache
+            model(self.x, self.context)
+            self.assertIs(model._fused_output_cache[0], weight)
+
+        # Converting the model (e.g. moving it to another device) should also
+        # convert the cached weights
+        model._apply(torch.clone)
+        self.assertIsNot(model._fused_output_cache[0], weight)
+        weight, bias = model._fused_output_cache
+        linears = [out_layer.output_linear.module
+                   for out_layer in model._output_layers]
+        self.assertTrue(torch.equal(
+            weight, torch.cat([linear.weight for linear in linears])
+        ))
+        self.assertTrue(torch.equal(
+            bias, torch.cat([linear.bias for linear in linears])
+        ))
+
+    def test_2_4_sparsity_pattern(self):
+        """
+        At most 2 of every 4 consecutive hidden weights should be non-zero, even after
+        the weights are updated and rezeroed.
+        """
+        model = DendriticMLP(output_size=4, sparsity_pattern="2:4", **self.model_args)
+
+        for layer in model._layers:
+            layer.module.weight.data.fill_(1.0)
+            layer.rezero_weights()
+
+            weight = layer.module.weight
+            groups = weight.view(weight.shape[0], -1, 4)
+            self.assertTrue(((groups != 0).sum(dim=-1) <= 2).all())
+
+    def test_2_4_inference_unsupported(self):
+        """
+        When the 2:4 conversion isn't supported (here on CPU), `optimize_for_inference`
+        should fail before modifying the model.
+        """
+        model = DendriticMLP(output_size=4, sparsity_pattern="2:4", **self.model_args)
+        model.eval()
+        num_buffers = len(list(model.buffers()))
+
+        with self.assertRaises((AssertionError, ImportError)):
+            model.optimize_for_inference()
+
+        self.assertIsNone(model._inference_dtype)
+        self.assertEqual(len(list(model.buffers())), num_buffers)
+        self.assertTrue(all(param.dtype == torch.float32
+                            for param in model.parameters()))
+        out = model(self.x, self.context)
+        self.assertEqual(out.dtype, torch.float32)
+
+    @unittest.skipUnless(torch.cuda.is_available()
+                         and torch.cuda.get_device_capability() >= (8, 0),
+                         "requires an Ampere or newer GPU")
+    def test_2_4_inference(self):
+        """
+        The semi-structured sparse model should match the same model converted with
+        dense weights.
+        """
+        model_args = dict(self.model_args, input_size=64, hidden_sizes=[64, 64])
+        model = DendriticMLP(output_size=4, sparsity_pattern="2:4", **model_args)
+        model = model.cuda().eval()
+        dense_model = deepcopy(model)
+        dense_model.sparsity_pattern = None
+
+        model.optimize_for_inference(dtype=torch.float16)
+        dense_model.optimize_for_inference(dtype=torch.float16)
+        for layer in model._layers:
+            self.assertIsInstance(layer.module.weight.data,
+                                  torch.sparse.SparseSemiStructuredTensor)
+
+        x = torch.rand(self.batch_size, 64, device="cuda")
+        context = self.context.cuda()
+        with torch.no_grad():
+            out = model(x, context)
+            expected = dense_model(x, context)
+        self.assertTrue(torch.allclose(out.float(), expected.float(), atol=1e-2))
+
+    def test_optimize_for_inference(self):
+        """Zero masks should be dropped once the weights are rezeroed and cast."""
+        model = DendriticMLP(output_size=4, **self.model_args)
+        masks = {name: buffer.bool() for name, buffer in model.named_buffers()
+                 if name.endswith("zero_mask")}
+
+        model.eval()
+        model.optimize_for_inference(dtype=torch.bfloat16)
+        params = dict(model.named_parameters())
+
+        self.assertFalse(any(name.endswith("zero_mask")
+                             for name, _ in model.named_buffers()))
+        for name, mask in masks.items():
+            prefix = name[:-len("zero_mask")]
+            weight_name = prefix + ("weights" if prefix.endswith("segments.")
+                                    else "module.weight")
+            weight = params[weight_name]
+            self.assertEqual(weight.dtype, torch.bfloat16)
+            self.assertTrue((weight[mask] == 0).all())
+
+        # The masks are gone, so the conversion can't be applied twice
+        with self.assertRaises(AssertionError):
+            model.optimize_for_inference(dtype=torch.bfloat16)
+
+    def test_fused_dendrite_segments(self):
+        """
+        After `optimize_for_inference`, the segments of each hidden layer should be
+        views into a single fused tensor, and the fused forward pass should match the
+        per-layer one.
+        """
+        model = DendriticMLP(output_size=4, **self.model_args)
+        model.eval()
+        model.optimize_for_inference()
+
+        fused = model._fused_segment_weights
+        self.assertEqual(fused.shape, (32, 3, self.dim_context))
+        start = 0
+        for layer in model._layers:
+            weights = layer.segments.weights
+            self.assertEqual(weights.data_ptr(), fused[start].data_ptr())
+            start += weights.shape[0]
+
+        # Converting the model (e.g. moving it to another device) copies every
+        # tensor; the segments should still be views into the fused tensor
+        model._apply(torch.clone)
+        fused = model._fused_segment_weights
+        start = 0
+        for layer in model._layers:
+            weights = layer.segments.weights
+            self.assertEqual(weights.data_ptr(), fused[start].data_ptr())
+            start += weights.shape[0]
+
+        with torch.no_grad():
+            out = model(self.x, self.context)
+            model._fused_segment_weights = None
+            expected = model(self.x, self.context)
+        self.assertEqual(out.shape, (self.batch_size, 4))
+        self.assertTrue(torch.allclose(out, expected))
+
+    def test_fused_dendrite_projection(self):
+        """
+        Every hidden layer should compute the same output from the single projection
+        of the fused segment weights as from its own segments, also when the layers
+        have different sizes.
+        """
+        model_args = dict(self.model_args, hidden_sizes=[16, 24])
+        model = DendriticMLP(output_size=4, **model_args)
+        model.eval()
+        model.optimize_for_inference()
+        self.assertEqual(model._fused_segment_weights.shape, (40, 3, self.dim_context))
+
+        hidden_outputs = []
+        for _, activation in model._hidden_blocks:
+            activation.register_forward_hook(
+                lambda module, inputs, output: hidden_outputs.append(output)
+            )
+
+        with torch.no_grad():
+            out = model(self.x, self.context)
+            model._fused_segment_weights = None
+            expected = model(self.x, self.context)
+
+        fused_outputs, layer_outputs = hidden_outputs[:2], hidden_outputs[2:]
+        for fused_output, layer_output in zip(fused_outputs, layer_outputs):
+            self.assertTrue(torch.allclose(fused_output, layer_output))
+        self.assertTrue(torch.allclose(out, expected))
+
+    @unittest.skipUnless(hasattr(torch, "compile"), "requires pytorch>=2.0")
+    def test_use_compile(self):
+        """
+        A compiled model should match the eager model in its outputs and gradients.
+        Copies should run their own hidden layers, and the model shouldn't reference
+        itself.
+        """
+        model = DendriticMLP(output_size=4, use_compile=True, **self.model_args)
+        eager_model = DendriticMLP(output_size=4, **self.model_args)
+        eager_model.load_state_dict(model.state_dict())
+
+        out = model(self.x, self.context)
+        eager_out = eager_model(self.x, self.context)
+        self.assertTrue(torch.allclose(out, eager_out, atol=1e-6))
+
+        out.sum().backward()
+        eager_out.sum().backward()
+        for param, eager_param in zip(model.parameters(),
+                                      eager_model.parameters()):
+            if param.grad is not None or eager_param.grad is not None:
+                self.assertTrue(torch.allclose(param.grad, eager_param.grad,
+                                               atol=1e-6))
+
+        # A copy should run its own hidden layers, not the original model's
+        model_copy = deepcopy(model)
+        with torch.no_grad():
+            for layer in model_copy._layers:
+                layer.module.weight.mul_(2.0)
+        eager_model.load_state_dict(model_copy.state_dict())
+        with torch.no_grad():
+            copy_out = model_copy(self.x, self.context)
+            self.assertTrue(torch.allclose(copy_out, eager_model(self.x, self.context),
+                                           atol=1e-6))
+            self.assertFalse(torch.allclose(copy_out, model(self.x, self.context)))
+
+            model_copy = pickle.loads(pickle.dumps(model_copy))
+            self.assertTrue(torch.allclose(model_copy(self.x, self.context), copy_out,
+                                           atol=1e-6))
+
+        gc.disable()
+        try:
+            model = DendriticMLP(output_size=4, use_compile=True, **self.model_args)
+            model_ref = weakref.ref(model)
+            del model
+            self.assertIsNone(model_ref())
+        finally:
+            gc.enable()
+
+
+class KWinnersInferenceTest(unittest.TestCase):
+    """
+    Tests the inference-only k-winners used by `DendriticMLP.optimize_for_inference`
+    """
+
+    def test_matches_kwinners(self):
+        kw = KWinners(n=50, percent_on=0.1, k_inference_factor=1.0,
+                      boost_strength=0.0, boost_strength_factor=0.0)
+        kw.eval()
+        kw_inference = _KWinnersInference(kw.k_inference)
+
+        x = torch.randn(8, 50)
+        self.assertTrue(torch.equal(kw(x), kw_inference(x)))
+        self.assertTrue(((kw_inference(x) != 0).sum(dim=-1) == 5).all())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)